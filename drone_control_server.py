@@ -4,265 +4,810 @@ drone_control_server.py (Production-Ready Version)
 Сервер управления боксами и станциями дронов.
 Основные улучшения:
 - Управление состоянием в памяти для высокой производительности (DeviceManager).
-- Потокобезопасность с использованием threading.Lock.
-- Корректная интеграция Flask (sync) и WebSocket (async).
+- Без блокировок: единственный писатель в цикле событий asyncio.
+- Единый ASGI-стек (FastAPI/Uvicorn): HTTP и WebSocket в одном цикле событий.
 - API-эндпоинты для динамического фронтенда.
 - Конфигурация вынесена для удобства развертывания.
 """
 import os
+import sys
+import time
+import hashlib
+import hmac
+import functools
+import uuid
+import re
+import logging
+from queue import SimpleQueue
+from logging.handlers import QueueHandler, QueueListener
 import bcrypt
 import asyncio
-import threading
-import json
-import websockets
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
-from flask_login import LoginManager, login_user, login_required, logout_user, current_user, UserMixin
+import importlib.util
+from collections import namedtuple, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+import orjson
+import uvicorn
+from fastapi import FastAPI, Request, Form, Depends, WebSocket, WebSocketDisconnect
+from fastapi.responses import RedirectResponse, Response
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+from starlette.middleware.sessions import SessionMiddleware
 
 # --- Конфигурация ---
 # В продакшене лучше использовать переменные окружения
 SECRET_KEY = os.environ.get('SECRET_KEY', 'supersecretkey-for-dev')
 DATA_FILE = 'data.json'
-WS_HOST = '0.0.0.0'
-WS_PORT = 8765
-FLASK_HOST = '0.0.0.0'
-FLASK_PORT = 5000
+HOST = '0.0.0.0'
+PORT = 5000
+# Параметры WebSocket (Uvicorn). Кадры телеметрии крошечные - permessage-deflate
+# не дает выигрыша, но держит zlib-буферы на каждое соединение, поэтому отключен.
+WS_PER_MESSAGE_DEFLATE = False
+# Кадры устройств - маленькие JSON-объекты, поэтому лимит строгий
+WS_MAX_SIZE = 4096
+WS_MAX_QUEUE = 8
+WS_PING_INTERVAL = 30.0
+WS_PING_TIMEOUT = 10.0
+# Поля телеметрии, которые сохраняются (остальные отбрасываются), и их типы
+TELEMETRY_FIELDS = {'status': str, 'battery': (int, float), 'temperature': (int, float)}
+# Известные статусы устройств; индекс в списке - код статуса в DeviceManager.
+# Статусы вне списка из телеметрии хранятся как 'unknown' - таблица не растет.
+DEVICE_STATUSES = ['offline', 'online', 'idle', 'charging', 'flying', 'unknown']
+# Известные команды устройств: их JSON-кадры собираются заранее при старте
+KNOWN_COMMANDS = ('open_cover', 'close_cover', 'takeoff', 'land', 'arm', 'disarm')
+# Максимум неотправленных команд на одно устройство
+OUTBOUND_QUEUE_SIZE = 64
+# Сколько последних команд хранить для /api/command_status
+COMMAND_STATUS_SIZE = 1024
+# Период (сек) пакетного применения входящей телеметрии
+TELEMETRY_FLUSH_INTERVAL = 0.5
+# Кэш успешных входов: повторный вход с тем же паролем не пересчитывает bcrypt
+LOGIN_CACHE_TTL = 300
+LOGIN_CACHE_SIZE = 256
+# В продакшене задайте LOG_LEVEL=WARNING, чтобы телеметрия не логировалась вовсе
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+
+# --- Логирование ---
+# Вне работы сервера записи пишутся напрямую. Пока работает сервер, обработчики
+# цикла событий только кладут запись в очередь (O(1)), а запись в поток
+# выполняет фоновый поток QueueListener.
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+log_queue = SimpleQueue()
+log_queue_handler = QueueHandler(log_queue)
+# QueueHandler форматирует запись до постановки в очередь - только текст сообщения,
+# иначе итоговый формат применился бы дважды
+log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_stream_handler])
+logger = logging.getLogger('drone_control_server')
+
+@contextmanager
+def queued_logging():
+    """На время работы сервера переключает корневой логгер на очередь и QueueListener."""
+    root = logging.getLogger()
+    listener = QueueListener(log_queue, log_stream_handler)
+    listener.start()
+    root.removeHandler(log_stream_handler)
+    root.addHandler(log_queue_handler)
+    try:
+        yield
+    finally:
+        root.removeHandler(log_queue_handler)
+        root.addHandler(log_stream_handler)
+        # stop() дописывает оставшиеся в очереди записи
+        listener.stop()
+
+# --- Инициализация FastAPI ---
+@asynccontextmanager
+async def lifespan(app):
+    with queued_logging():
+        flusher = asyncio.create_task(device_manager.run_telemetry_flusher())
+        yield
+        flusher.cancel()
+        try:
+            await flusher
+        except asyncio.CancelledError:
+            pass
+
+app = FastAPI(lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+app.add_middleware(SessionMiddleware, secret_key=SECRET_KEY)
+app.mount('/static', StaticFiles(directory='static'), name='static')
+templates = Jinja2Templates(directory='templates')
+
+# --- Ответы JSON ---
+def json_bytes_response(content, status_code=200):
+    """Response для уже сериализованного JSON (bytes)."""
+    return Response(content, status_code=status_code, media_type='application/json')
+
+def json_response(obj, status_code=200):
+    """Сериализует obj через orjson, минуя кодировщик FastAPI."""
+    return json_bytes_response(orjson.dumps(obj), status_code)
+
+INVALID_JSON_RESPONSE = {"status": "error", "message": "Тело запроса должно быть JSON-объектом"}
+
+async def read_json_object(request: Request):
+    """Разбирает тело запроса; возвращает dict или None, если это не JSON-объект."""
+    try:
+        data = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+NO_TELEMETRY_JSON = orjson.dumps({"error": "no data for this device"})
+
+# --- Кадры команд ---
+# Готовые кадры для команд без значения и префиксы '{"command":"...","value":' для команд со значением
+CMD_TEMPLATES = {cmd: orjson.dumps({"command": cmd}).decode() for cmd in KNOWN_COMMANDS}
+CMD_TEMPLATES_VALUE = {cmd: frame[:-1] + ',"value":' for cmd, frame in CMD_TEMPLATES.items()}
+
+def encode_command(command, value=None):
+    """Возвращает JSON-кадр команды; для известных команд - из заранее собранных шаблонов."""
+    if value is None:
+        frame = CMD_TEMPLATES.get(command)
+        if frame is not None:
+            return frame
+        return orjson.dumps({"command": command}).decode()
+    value = str(value)
+    prefix = CMD_TEMPLATES_VALUE.get(command)
+    if prefix is not None:
+        # orjson экранирует значение, поэтому подстановка безопасна
+        return prefix + orjson.dumps(value).decode() + '}'
+    return orjson.dumps({"command": command, "value": value}).decode()
+
+# --- Менеджер состояний ---
+# Формат bcrypt-хэша: $2b$<cost>$<22 символа соли + 31 символ хэша>
+BCRYPT_HASH_RE = re.compile(r'^\$2[aby]\$(0[4-9]|[12][0-9]|3[01])\$[./A-Za-z0-9]{53}$')
+
+# Соединение устройства: websocket, очередь исходящих кадров (кадр, Future доставки или None)
+# и задача-отправитель
+DeviceConnection = namedtuple('DeviceConnection', ['websocket', 'queue', 'writer'])
+
+class DashboardSubscriber:
+    """
+    Подписка браузерной панели на изменения. Кадры хранятся по ключу и
+    перезаписываются, так что медленный клиент получает последнее состояние,
+    а память ограничена числом устройств.
+    """
+    def __init__(self):
+        self.pending = {}
+        self.event = asyncio.Event()
 
-# --- Инициализация Flask ---
-app = Flask(__name__)
-app.secret_key = SECRET_KEY
+    def publish(self, key, frame):
+        self.pending[key] = frame
+        self.event.set()
 
-# --- Flask-Login ---
-login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+    async def next_frames(self):
+        await self.event.wait()
+        self.event.clear()
+        frames, self.pending = self.pending, {}
+        return list(frames.values())
 
-# --- Потокобезопасный менеджер состояний ---
 class DeviceManager:
     """
-    Класс для управления состоянием устройств в памяти. Потокобезопасен.
+    Класс для управления состоянием устройств в памяти.
+
+    Все обращения выполняются из единственного цикла событий ASGI-сервера,
+    поэтому писатель один, а операции над отдельными ключами dict атомарны -
+    блокировки не нужны.
     """
     def __init__(self, device_config):
-        self.lock = threading.Lock()
-        # Статическая информация об устройствах (имя, пароль)
-        self.devices_config = {d['name']: d for d in device_config}
-        # Динамическое состояние (статус, телеметрия, websocket-соединение)
+        # Статическая информация об устройствах (без секретов - уходит в API)
+        self.devices_config = {}
+        # Учетные данные: имя -> (это bcrypt-хэш?, bytes)
+        self.credentials = {}
+        for device in device_config:
+            name = device['name']
+            self.devices_config[name] = {
+                k: v for k, v in device.items() if k not in ('password', 'password_hash')
+            }
+            # Ошибки конфигурации обнаруживаются при старте, а не при первом подключении
+            if 'password_hash' in device:
+                if not BCRYPT_HASH_RE.match(device['password_hash']):
+                    raise ValueError(f"device {name!r}: password_hash is not a valid bcrypt hash")
+                self.credentials[name] = (True, device['password_hash'].encode('utf-8'))
+            elif isinstance(device.get('password'), str):
+                self.credentials[name] = (False, device['password'].encode('utf-8'))
+            else:
+                raise ValueError(f"device {name!r}: password or password_hash is required")
+        # Динамическое состояние (статус, телеметрия, DeviceConnection)
         self.clients = {}
         self.last_telemetry = {}
-        self.statuses = {name: "offline" for name in self.devices_config}
-
-    def get_device_config(self, name):
-        return self.devices_config.get(name)
+        # Сериализованная телеметрия для /api/telemetry, строится лениво при чтении
+        self._telemetry_json = {}
+        # Статусы: 1 байт на устройство (код из self._status_names) вместо dict строк
+        self._name_to_idx = {name: i for i, name in enumerate(self.devices_config)}
+        self._status_names = list(DEVICE_STATUSES)
+        self._status_codes = {status: code for code, status in enumerate(self._status_names)}
+        self._status_arr = bytearray(len(self._name_to_idx))
+        # Кэш сериализованного ответа /api/devices, сбрасывается при смене статуса
+        self._devices_json_cache = None
+        self._cache_dirty = True
+        # Последний необработанный кадр телеметрии на устройство (применяются пакетом)
+        self._pending = {}
+        self._frames_received = 0
+        # Подписчики браузерной панели (/ws/dashboard)
+        self.subscribers = set()
+
+    async def check_password(self, name, password):
+        """
+        Проверяет пароль устройства. bcrypt-хэш проверяется в пуле потоков,
+        пароль в открытом виде - через hmac.compare_digest (постоянное время).
+        """
+        credential = self.credentials.get(name)
+        if credential is None:
+            return False
+        is_hash, secret = credential
+        password = password.encode('utf-8')
+        if is_hash:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, bcrypt.checkpw, password, secret)
+        return hmac.compare_digest(secret, password)
+
+    def _status_code(self, status):
+        # Статусы вне DEVICE_STATUSES не добавляются в таблицу - устройство не может ее раздуть
+        return self._status_codes.get(status, self._status_codes['unknown'])
+
+    def _set_status(self, name, status):
+        """Записывает статус; возвращает True, если он изменился."""
+        idx = self._name_to_idx[name]
+        code = self._status_code(status)
+        if self._status_arr[idx] == code:
+            return False
+        self._status_arr[idx] = code
+        return True
 
     def get_all_statuses(self):
-        with self.lock:
-            return list(self.statuses.items())
+        snapshot = bytes(self._status_arr)
+        names = self._status_names
+        return [(name, names[code]) for name, code in zip(self._name_to_idx, snapshot)]
 
     def get_full_device_data(self):
-        with self.lock:
-            # Возвращает полные данные для API
-            data = []
-            for name, config in self.devices_config.items():
-                device_data = config.copy()
-                device_data['status'] = self.statuses.get(name, "offline")
-                data.append(device_data)
-            return data
-
-    def set_online(self, name, websocket):
-        with self.lock:
-            self.clients[name] = websocket
-            self.statuses[name] = "online"
-        print(f"✅ Устройство {name} подключилось")
-
-    def set_offline(self, name):
-        with self.lock:
-            self.clients.pop(name, None)
-            self.statuses[name] = "offline"
-        print(f"❌ Устройство {name} отключилось")
+        # Возвращает полные данные для API
+        data = []
+        snapshot = bytes(self._status_arr)
+        names = self._status_names
+        for config, code in zip(list(self.devices_config.values()), snapshot):
+            device_data = config.copy()
+            device_data['status'] = names[code]
+            data.append(device_data)
+        return data
+
+    def get_full_device_data_json(self):
+        """Возвращает get_full_device_data() в виде готовых JSON-байтов (с кэшем)."""
+        if self._cache_dirty or self._devices_json_cache is None:
+            self._devices_json_cache = orjson.dumps(self.get_full_device_data())
+            self._cache_dirty = False
+        return self._devices_json_cache
+
+    async def set_online(self, name, websocket):
+        """Регистрирует соединение; прежнее соединение устройства с тем же именем закрывается."""
+        queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        writer = asyncio.create_task(self._writer(websocket, queue))
+        previous = self.clients.get(name)
+        self.clients[name] = DeviceConnection(websocket, queue, writer)
+        self._set_status(name, "online")
+        self._cache_dirty = True
+        self._publish_devices()
+        logger.info("✅ Устройство %s подключилось", name)
+        if previous:
+            previous.writer.cancel()
+            try:
+                await previous.websocket.close(code=1000, reason="replaced by new connection")
+            except (WebSocketDisconnect, RuntimeError, OSError):
+                # Прежнее соединение уже закрыто
+                pass
+
+    def is_current(self, name, websocket):
+        """True, если websocket - текущее зарегистрированное соединение устройства."""
+        connection = self.clients.get(name)
+        return connection is not None and connection.websocket is websocket
+
+    def set_offline(self, name, websocket):
+        # Закрытие замененного соединения не должно затрагивать новое
+        if not self.is_current(name, websocket):
+            return
+        connection = self.clients.pop(name)
+        connection.writer.cancel()
+        # Writer мог завершиться раньше (ошибка отправки) - команды в очереди уже не уйдут
+        self._fail_pending(connection.queue)
+        self._pending.pop(name, None)
+        # Телеметрия отключенного устройства не хранится - память не растет со временем
+        self.last_telemetry.pop(name, None)
+        self._telemetry_json.pop(name, None)
+        self._set_status(name, "offline")
+        self._cache_dirty = True
+        self._publish_devices()
+        logger.info("❌ Устройство %s отключилось", name)
 
     def update_telemetry(self, name, telemetry_data):
-        with self.lock:
-            self.last_telemetry[name] = telemetry_data
-            if 'status' in telemetry_data:
-                self.statuses[name] = telemetry_data['status']
-        print(f"📡 Телеметрия от {name}: {telemetry_data.get('status', 'unknown')}")
-
-    def get_telemetry(self, name):
-        with self.lock:
-            return self.last_telemetry.get(name, {"error": "no data for this device"})
-
-    def get_websocket(self, name):
-        with self.lock:
-            return self.clients.get(name)
-
-# --- Глобальные переменные для взаимодействия потоков ---
+        # Только запоминаем кадр (уже очищенный sanitize_telemetry); применяет его flush_telemetry()
+        telemetry_data['ts'] = time.time()
+        self._pending[name] = telemetry_data
+        self._frames_received += 1
+
+    def flush_telemetry(self):
+        """Применяет накопленную телеметрию к last_telemetry и статусам одним пакетом."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        frames, self._frames_received = self._frames_received, 0
+
+        self.last_telemetry.update(pending)
+        for name in pending:
+            self._telemetry_json.pop(name, None)
+        for name, telemetry_data in pending.items():
+            status = telemetry_data.get('status')
+            if status is not None and self._set_status(name, status):
+                self._cache_dirty = True
+        if self.subscribers:
+            if self._cache_dirty:
+                self._publish_devices()
+            for name in pending:
+                self._publish(('telemetry', name), self._telemetry_frame(name))
+        logger.info("📡 Телеметрия: %d кадров от %d устройств", frames, len(pending))
+
+    async def run_telemetry_flusher(self, interval=TELEMETRY_FLUSH_INTERVAL):
+        """Фоновая задача: периодически вызывает flush_telemetry()."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.flush_telemetry()
+            except Exception:
+                # Ошибка одного пакета не должна останавливать прием телеметрии
+                logger.exception("Ошибка при применении телеметрии")
+
+    def get_telemetry_json(self, name):
+        """
+        Возвращает последнюю телеметрию устройства в виде JSON-байтов (с кэшем
+        до следующего кадра) или NO_TELEMETRY_JSON, если данных нет.
+        """
+        cached = self._telemetry_json.get(name)
+        if cached is None:
+            if name not in self.last_telemetry:
+                return NO_TELEMETRY_JSON
+            cached = self._telemetry_json[name] = orjson.dumps(self.last_telemetry[name])
+        return cached
+
+    def get_connection(self, name):
+        return self.clients.get(name)
+
+    # --- Рассылка изменений в браузерную панель ---
+    def subscribe(self):
+        """Создает подписчика; первыми он получит список устройств и всю текущую телеметрию."""
+        subscriber = DashboardSubscriber()
+        subscriber.publish('devices', self._devices_frame())
+        for name in list(self.last_telemetry):
+            subscriber.publish(('telemetry', name), self._telemetry_frame(name))
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def _devices_frame(self):
+        return '{"type":"devices","devices":' + self.get_full_device_data_json().decode() + '}'
+
+    def _telemetry_frame(self, name):
+        return orjson.dumps({"type": "telemetry", "name": name, "telemetry": self.last_telemetry[name]}).decode()
+
+    def _publish_devices(self):
+        if self.subscribers:
+            self._publish('devices', self._devices_frame())
+
+    def _publish(self, key, frame):
+        # Кадр кодируется один раз и разделяется всеми подписчиками
+        for subscriber in list(self.subscribers):
+            subscriber.publish(key, frame)
+
+    def get_all_connections(self, group=None):
+        """Возвращает [(имя, DeviceConnection)] подключенных устройств; group - тип устройства."""
+        return [
+            (name, connection) for name, connection in list(self.clients.items())
+            if group is None or self.devices_config[name].get('type') == group
+        ]
+
+    @staticmethod
+    async def _writer(websocket, queue):
+        """
+        Единственный отправитель кадров в websocket устройства. Future доставки
+        получает True после отправки и False, если соединение закрылось раньше.
+        """
+        delivered = None
+        try:
+            while True:
+                message, delivered = await queue.get()
+                await websocket.send_text(message)
+                if delivered is not None and not delivered.done():
+                    delivered.set_result(True)
+                delivered = None
+        except (WebSocketDisconnect, RuntimeError, OSError):
+            # Соединение закрыто - ws_handler сам переведет устройство в offline
+            pass
+        finally:
+            if delivered is not None and not delivered.done():
+                delivered.set_result(False)
+            DeviceManager._fail_pending(queue)
+
+    @staticmethod
+    def _fail_pending(queue):
+        """Опустошает очередь исходящих кадров, помечая их Future доставки как неудачные."""
+        while not queue.empty():
+            _, delivered = queue.get_nowait()
+            if delivered is not None and not delivered.done():
+                delivered.set_result(False)
+
+# --- Глобальное состояние ---
 # Загружаем конфигурацию один раз при старте
 try:
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        initial_data = json.load(f)
-except (FileNotFoundError, json.JSONDecodeError) as e:
-    print(f"CRITICAL ERROR: Cannot load or parse {DATA_FILE}: {e}")
+    with open(DATA_FILE, 'rb') as f:
+        initial_data = orjson.loads(f.read())
+except (FileNotFoundError, orjson.JSONDecodeError) as e:
+    logger.critical("Cannot load or parse %s: %s", DATA_FILE, e)
     exit(1)
 
-device_manager = DeviceManager(initial_data['devices'])
-users_data = {u['username']: u for u in initial_data['users']}
-users_by_id = {str(u['id']): u for u in initial_data['users']}
-
-# Цикл событий asyncio для WebSocket сервера
-websocket_event_loop = None
+try:
+    device_manager = DeviceManager(initial_data['devices'])
+except ValueError as e:
+    logger.critical("Invalid device configuration in %s: %s", DATA_FILE, e)
+    exit(1)
+# Плоские таблицы пользователей; хэши кодируем в bytes один раз, а не на каждый /login
+users_creds = {u['username']: (u['id'], u['password_hash'].encode('utf-8')) for u in initial_data['users']}
+users_by_id = {str(u['id']): u['username'] for u in initial_data['users']}
 
 # --- Модель пользователя ---
-class User(UserMixin):
+class User:
     def __init__(self, id_, username):
         self.id = id_
         self.username = username
 
-@login_manager.user_loader
+@functools.lru_cache(maxsize=1024)
+def _build_user(user_id):
+    # users_by_id загружается один раз при старте и не меняется - кэш всегда актуален
+    username = users_by_id.get(user_id)
+    return User(user_id, username) if username else None
+
 def load_user(user_id):
-    user_info = users_by_id.get(user_id)
-    return User(user_info['id'], user_info['username']) if user_info else None
+    return _build_user(user_id)
+
+class NotAuthenticated(Exception):
+    """Пользователь не вошел в систему."""
+
+def login_required(request: Request):
+    """Зависимость FastAPI: возвращает текущего пользователя из сессии."""
+    user_id = request.session.get('user_id')
+    user = load_user(user_id) if user_id else None
+    if user is None:
+        raise NotAuthenticated()
+    return user
+
+@app.exception_handler(NotAuthenticated)
+async def not_authenticated_handler(request: Request, exc: NotAuthenticated):
+    return RedirectResponse(request.url_for('login'), status_code=303)
+
+def flash(request: Request, message, category="message"):
+    request.session.setdefault('_flashes', []).append([category, message])
+
+def get_flashed_messages(request: Request):
+    return request.session.pop('_flashes', [])
 
 # --- Аутентификация ---
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    if current_user.is_authenticated:
-        return redirect(url_for('index'))
-    if request.method == 'POST':
-        username = request.form['username']
-        password = request.form['password'].encode('utf-8')
-        user_info = users_data.get(username)
-
-        if user_info and bcrypt.checkpw(password, user_info['password_hash'].encode('utf-8')):
-            login_user(User(user_info['id'], username))
-            return redirect(url_for('index'))
-
-        flash("Неверный логин или пароль", "error")
-        return redirect(url_for('login'))
-    return render_template('login.html')
-
-@app.route('/logout')
-@login_required
-def logout():
-    logout_user()
-    return redirect(url_for('login'))
+# (username, sha256(password)) -> время истечения (time.monotonic); порядок - LRU
+login_cache = OrderedDict()
+
+async def verify_password(username, password, password_hash):
+    """
+    Проверяет пароль через bcrypt в пуле потоков, чтобы не блокировать цикл событий.
+    Успешные проверки кэшируются на LOGIN_CACHE_TTL секунд (не более
+    LOGIN_CACHE_SIZE записей, вытесняются давно не использованные).
+    """
+    key = (username, hashlib.sha256(password).digest())
+    now = time.monotonic()
+    expires = login_cache.get(key)
+    if expires is not None:
+        if expires > now:
+            login_cache.move_to_end(key)
+            return True
+        del login_cache[key]
+
+    loop = asyncio.get_running_loop()
+    if not await loop.run_in_executor(None, bcrypt.checkpw, password, password_hash):
+        return False
+
+    # Истекшие записи удаляем здесь: это происходит только после полной проверки bcrypt
+    for expired_key in [k for k, exp in login_cache.items() if exp <= now]:
+        del login_cache[expired_key]
+    login_cache[key] = now + LOGIN_CACHE_TTL
+    if len(login_cache) > LOGIN_CACHE_SIZE:
+        login_cache.popitem(last=False)
+    return True
+
+@app.get('/login', name='login')
+async def login_form(request: Request):
+    if load_user(request.session.get('user_id')):
+        return RedirectResponse(request.url_for('index'), status_code=303)
+    return templates.TemplateResponse(request, 'login.html', {
+        'messages': get_flashed_messages(request),
+    })
+
+@app.post('/login')
+async def login(request: Request, username: str = Form(...), password: str = Form(...)):
+    creds = users_creds.get(username)
+
+    if creds:
+        user_id, password_hash = creds
+        if await verify_password(username, password.encode('utf-8'), password_hash):
+            request.session['user_id'] = str(user_id)
+            return RedirectResponse(request.url_for('index'), status_code=303)
+
+    flash(request, "Неверный логин или пароль", "error")
+    return RedirectResponse(request.url_for('login'), status_code=303)
+
+@app.get('/logout')
+async def logout(request: Request, user: User = Depends(login_required)):
+    request.session.clear()
+    return RedirectResponse(request.url_for('login'), status_code=303)
 
 # --- Веб-интерфейс (HTML) ---
-@app.route('/')
-@login_required
-def index():
-    return render_template('index.html', username=current_user.username)
+@app.get('/')
+async def index(request: Request, user: User = Depends(login_required)):
+    return templates.TemplateResponse(request, 'index.html', {'username': user.username})
 
 # --- API эндпоинты (JSON) ---
-@app.route('/api/devices', methods=['GET'])
-@login_required
-def get_devices_status():
+@app.get('/api/devices')
+async def get_devices_status(user: User = Depends(login_required)):
     """Возвращает JSON со списком всех устройств и их статусом."""
-    return jsonify(device_manager.get_full_device_data())
+    return json_bytes_response(device_manager.get_full_device_data_json())
 
-@app.route('/api/telemetry', methods=['GET'])
-@login_required
-def get_telemetry():
+@app.get('/api/telemetry')
+async def get_telemetry(device: str = None, user: User = Depends(login_required)):
     """Возвращает последнюю телеметрию для указанного устройства."""
-    device_name = request.args.get('device')
-    if not device_name:
-        return jsonify({"error": "device name is required"}), 400
-    return jsonify(device_manager.get_telemetry(device_name))
-
-@app.route('/api/send_command', methods=['POST'])
-@login_required
-def send_command_api():
+    if not device:
+        return json_response({"error": "device name is required"}, 400)
+    return json_bytes_response(device_manager.get_telemetry_json(device))
+
+@app.post('/api/send_command')
+async def send_command_api(request: Request, user: User = Depends(login_required)):
     """Принимает команду и отправляет ее устройству через WebSocket."""
-    data = request.json
+    data = await read_json_object(request)
+    if data is None:
+        return json_response(INVALID_JSON_RESPONSE, 400)
     name = data.get('device_name')
     command = data.get('command')
     value = data.get('value', None)
 
-    if not name or not command:
-        return jsonify({"status": "error", "message": "Заполните обязательные поля"}), 400
+    if not isinstance(name, str) or not isinstance(command, str) or not name or not command:
+        return json_response({"status": "error", "message": "Заполните обязательные поля"}, 400)
 
     try:
-        # Корректно вызываем async функцию из sync контекста Flask
-        future = asyncio.run_coroutine_threadsafe(
-            send_command_to_device(name, command, value),
-            websocket_event_loop
-        )
-        # Ждем результат (опционально, но хорошо для обратной связи)
-        success = future.get(timeout=5)
-
-        if success:
-            return jsonify({"status": "ok", "message": f"Команда '{command}' отправлена устройству {name}"})
+        # Команда только ставится в очередь; доставку можно проверить через /api/command_status
+        delivered = send_command_to_device(name, command, value)
+
+        if delivered is not None:
+            command_id = track_command(delivered)
+            return json_response({
+                "status": "queued",
+                "id": command_id,
+                "message": f"Команда '{command}' поставлена в очередь устройства {name}",
+            }, 202)
         else:
-            return jsonify({"status": "error", "message": f"Устройство {name} не в сети или не найдено"}), 404
+            return json_response({"status": "error", "message": f"Устройство {name} не в сети или не найдено"}, 404)
+
+    except asyncio.QueueFull:
+        # Устройство в сети, но не успевает принимать команды - клиент может повторить позже
+        return json_response({"status": "error", "message": f"Очередь команд устройства {name} переполнена, повторите позже"}, 503)
 
     except Exception as e:
-        print(f"Ошибка при отправке команды: {e}")
-        return jsonify({"status": "error", "message": f"Ошибка сервера: {str(e)}"}), 500
+        logger.exception("Ошибка при отправке команды")
+        return json_response({"status": "error", "message": f"Ошибка сервера: {str(e)}"}, 500)
+
+@app.get('/api/command_status/{command_id}')
+async def command_status_api(command_id: str, user: User = Depends(login_required)):
+    """Возвращает состояние доставки команды: queued, sent или failed."""
+    delivered = command_results.get(command_id)
+    if delivered is None:
+        return json_response({"status": "error", "message": "Команда не найдена"}, 404)
+    if not delivered.done():
+        status = "queued"
+    else:
+        status = "sent" if delivered.result() else "failed"
+    return json_response({"id": command_id, "status": status})
+
+@app.post('/api/broadcast')
+async def broadcast_api(request: Request, user: User = Depends(login_required)):
+    """Отправляет одну команду всем подключенным устройствам (или устройствам одного типа)."""
+    data = await read_json_object(request)
+    if data is None:
+        return json_response(INVALID_JSON_RESPONSE, 400)
+    command = data.get('command')
+    value = data.get('value', None)
+    group = data.get('group', None)
+
+    if not isinstance(command, str) or not command or not (group is None or isinstance(group, str)):
+        return json_response({"status": "error", "message": "Заполните обязательные поля"}, 400)
+
+    sent, skipped = broadcast_command(command, value, group)
+    if not sent and not skipped:
+        return json_response({"status": "error", "message": "Нет устройств в сети"}, 404)
+    return json_response({
+        "status": "ok",
+        "message": f"Команда '{command}' отправлена устройствам: {len(sent)}",
+        "sent": sent,
+        "skipped": skipped,
+    })
+
+# --- WebSocket браузерной панели ---
+async def dashboard_sender(websocket, subscriber):
+    """Отправляет панели кадры по мере их появления у подписчика."""
+    try:
+        while True:
+            for frame in await subscriber.next_frames():
+                await websocket.send_text(frame)
+    except (WebSocketDisconnect, RuntimeError, OSError):
+        pass
+
+@app.websocket('/ws/dashboard')
+async def dashboard_ws_handler(websocket: WebSocket):
+    """Push-канал для веб-интерфейса: снимок состояния при подключении, затем изменения."""
+    if load_user(websocket.session.get('user_id')) is None:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+
+    subscriber = device_manager.subscribe()
+    sender = asyncio.create_task(dashboard_sender(websocket, subscriber))
+    try:
+        # Сообщения от браузера не ожидаются - ждем только закрытия соединения
+        while (await websocket.receive())['type'] != 'websocket.disconnect':
+            pass
+    finally:
+        sender.cancel()
+        device_manager.unsubscribe(subscriber)
 
 # --- WebSocket-сервер ---
-async def ws_handler(websocket):
+async def receive_frame(websocket: WebSocket):
+    """Возвращает содержимое очередного кадра (str или bytes - orjson разбирает оба)."""
+    message = await websocket.receive()
+    if message['type'] == 'websocket.disconnect':
+        raise WebSocketDisconnect(message.get('code', 1000))
+    text = message.get('text')
+    return text if text is not None else message.get('bytes')
+
+def parse_frame(frame):
+    """
+    Разбирает кадр устройства. Перед вызовом парсера дешево отсекает кадры
+    больше WS_MAX_SIZE и всё, что не начинается как JSON-объект.
+    Возвращает dict или None.
+    """
+    if not frame or len(frame) > WS_MAX_SIZE or frame[:1] not in ('{', b'{'):
+        return None
+    return orjson.loads(frame)
+
+def sanitize_telemetry(data):
+    """Оставляет только известные поля телеметрии с ожидаемыми типами."""
+    telemetry = {}
+    for field, field_type in TELEMETRY_FIELDS.items():
+        value = data.get(field)
+        if isinstance(value, field_type):
+            telemetry[field] = value
+    return telemetry
+
+async def send_json(websocket: WebSocket, obj):
+    """Отправляет объект текстовым JSON-кадром."""
+    await websocket.send_text(orjson.dumps(obj).decode())
+
+@app.websocket('/ws')
+async def ws_handler(websocket: WebSocket):
     """Обрабатывает подключения устройств через WebSocket."""
+    await websocket.accept()
     device_name = None
     try:
-        auth_message = await asyncio.wait_for(websocket.recv(), timeout=10.0)
-        auth_data = json.loads(auth_message)
+        auth_message = await asyncio.wait_for(receive_frame(websocket), timeout=10.0)
+        auth_data = parse_frame(auth_message)
 
-        if auth_data.get('type') != 'auth':
-            await websocket.send(json.dumps({"error": "auth_required"}))
+        if auth_data is None or auth_data.get('type') != 'auth':
+            await send_json(websocket, {"error": "auth_required"})
             return
 
-        device_name = auth_data.get('name')
+        name = auth_data.get('name')
         password = auth_data.get('password')
-        device_config = device_manager.get_device_config(device_name)
-
-        if not device_config or device_config['password'] != password:
-            await websocket.send(json.dumps({"error": "unauthorized"}))
+        if (not isinstance(name, str) or not isinstance(password, str)
+                or not await device_manager.check_password(name, password)):
+            await send_json(websocket, {"error": "unauthorized"})
             return
 
-        device_manager.set_online(device_name, websocket)
-        await websocket.send(json.dumps({"status": "ok", "message": "authenticated"}))
-
-        async for message in websocket:
-            data = json.loads(message)
-            if data.get('type') == 'telemetry':
-                device_manager.update_telemetry(device_name, data)
-
-    except (websockets.exceptions.ConnectionClosed, asyncio.TimeoutError, json.JSONDecodeError) as e:
-        print(f"Соединение с {device_name or 'unknown device'} закрыто: {type(e).__name__}")
+        # Подтверждение отправляем до запуска задачи-отправителя, чтобы кадры не перемешались
+        await send_json(websocket, {"status": "ok", "message": "authenticated"})
+        device_name = name
+        await device_manager.set_online(device_name, websocket)
+
+        while True:
+            data = parse_frame(await receive_frame(websocket))
+            if data is not None and data.get('type') == 'telemetry':
+                if not device_manager.is_current(device_name, websocket):
+                    # Устройство переподключилось - это соединение больше не обслуживаем
+                    break
+                device_manager.update_telemetry(device_name, sanitize_telemetry(data))
+
+    except (WebSocketDisconnect, asyncio.TimeoutError, orjson.JSONDecodeError) as e:
+        logger.info("Соединение с %s закрыто: %s", device_name or 'unknown device', type(e).__name__)
     finally:
         if device_name:
-            device_manager.set_offline(device_name)
+            device_manager.set_offline(device_name, websocket)
 
-async def send_command_to_device(name, command, value=None):
-    """Асинхронно отправляет команду подключенному устройству."""
-    ws = device_manager.get_websocket(name)
-    if not ws:
-        return False
+# id команды -> Future доставки; старые записи вытесняются (LRU)
+command_results = OrderedDict()
 
-    cmd_payload = {"command": command}
-    if value is not None:
-        cmd_payload["value"] = str(value)
+def track_command(delivered):
+    """Сохраняет Future доставки команды и возвращает ее id."""
+    command_id = uuid.uuid4().hex
+    command_results[command_id] = delivered
+    if len(command_results) > COMMAND_STATUS_SIZE:
+        command_results.popitem(last=False)
+    return command_id
 
-    await ws.send(json.dumps(cmd_payload))
-    return True
+def send_command_to_device(name, command, value=None):
+    """
+    Ставит команду в очередь исходящих кадров устройства и сразу возвращает
+    Future доставки. Возвращает None, если устройство не в сети.
+    Если очередь устройства переполнена, пробрасывает asyncio.QueueFull.
+    """
+    connection = device_manager.get_connection(name)
+    # Завершившийся writer означает, что соединение уже мертво, хоть ws_handler этого еще не заметил
+    if not connection or connection.writer.done():
+        return None
 
-def start_websocket_server():
-    """Запускает WebSocket сервер в отдельном потоке."""
-    global websocket_event_loop
-    # Создаем и сохраняем event loop для этого потока
-    websocket_event_loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(websocket_event_loop)
+    delivered = asyncio.get_running_loop().create_future()
+    try:
+        connection.queue.put_nowait((encode_command(command, value), delivered))
+    except asyncio.QueueFull:
+        logger.warning("Очередь команд устройства %s переполнена", name)
+        raise
+    return delivered
 
-    server = websockets.serve(ws_handler, WS_HOST, WS_PORT)
-    websocket_event_loop.run_until_complete(server)
-    websocket_event_loop.run_forever()
+def broadcast_command(command, value=None, group=None):
+    """
+    Рассылает команду всем подключенным устройствам группы. Кадр кодируется один раз
+    и кладется в очереди соединений; устройства с переполненной очередью пропускаются.
+    Возвращает (имена получивших, имена пропущенных).
+    """
+    frame = encode_command(command, value)
+    sent, skipped = [], []
+    for name, connection in device_manager.get_all_connections(group):
+        if connection.writer.done():
+            continue
+        try:
+            connection.queue.put_nowait((frame, None))
+            sent.append(name)
+        except asyncio.QueueFull:
+            skipped.append(name)
+    if skipped:
+        logger.warning("Рассылка '%s': пропущены устройства с переполненной очередью: %s", command, skipped)
+    return sent, skipped
 
 # --- Точка входа ---
+def select_event_loop():
+    """
+    Возвращает значение параметра loop для Uvicorn: uvloop на Linux/macOS,
+    winloop на Windows (ставится как политика цикла), иначе стандартный asyncio.
+    """
+    if sys.platform == 'win32':
+        if importlib.util.find_spec('winloop') is None:
+            return 'asyncio'
+        import winloop
+        winloop.install()
+        return 'none'
+    return 'uvloop' if importlib.util.find_spec('uvloop') is not None else 'asyncio'
+
 if __name__ == '__main__':
-    # Запускаем WebSocket сервер в фоновом потоке
-    ws_thread = threading.Thread(target=start_websocket_server, daemon=True)
-    ws_thread.start()
-
-    # Запускаем Flask сервер (для разработки)
-    # В продакшене используйте Gunicorn: gunicorn --worker-class eventlet -w 1 drone_control_server:app
-    print(f"Flask-сервер запущен на http://{FLASK_HOST}:{FLASK_PORT}")
-    print(f"WebSocket-сервер запущен на ws://{WS_HOST}:{WS_PORT}")
-    app.run(host=FLASK_HOST, port=FLASK_PORT, debug=True)
+    # Для продакшена: uvicorn drone_control_server:app --host 0.0.0.0 --port 5000 --workers 1 --loop uvloop --http httptools \
+    #     --ws-per-message-deflate false --ws-max-size 4096 --ws-max-queue 8 --ws-ping-interval 30 --ws-ping-timeout 10
+    # Один воркер обязателен: состояние устройств хранится в памяти процесса.
+    logger.info("HTTP-сервер запущен на http://%s:%s", HOST, PORT)
+    logger.info("WebSocket для устройств: ws://%s:%s/ws", HOST, PORT)
+    uvicorn.run(
+        app, host=HOST, port=PORT, workers=1, loop=select_event_loop(), http='httptools',
+        ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE,
+        ws_max_size=WS_MAX_SIZE,
+        ws_max_queue=WS_MAX_QUEUE,
+        ws_ping_interval=WS_PING_INTERVAL,
+        ws_ping_timeout=WS_PING_TIMEOUT,
+    )
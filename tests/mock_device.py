@@ -1,84 +1,106 @@
+import sys
 import asyncio
 import websockets
-import json
+import orjson
 import random
 
-# --- Настройки мок-устройства ---
-DEVICE_NAME = "esp01"
-DEVICE_PASSWORD = "1234"
-SERVER_URI = "ws://localhost:8765"
-# Если используете Nginx, то: "ws://your_domain.com/ws/"
+# --- Настройки мок-устройств ---
+# Устройства из data.json: (имя, пароль). Для нагрузочного теста на N устройств
+# добавьте N записей сюда и соответствующие устройства в data.json.
+DEVICES = [
+    ("esp01", "1234"),
+    ("esp02", "5678"),
+    ("esp03", "abcd"),
+]
+SERVER_URI = "ws://localhost:5000/ws"
+# Если используете Nginx, то: "ws://your_domain.com/ws"
+TELEMETRY_INTERVAL = 10
 
-async def run_mock_device():
+async def run_mock_device(device_name, device_password):
     """
     Имитирует работу устройства: подключается, аутентифицируется,
     отправляет телеметрию и слушает команды.
     """
+    # Кадр аутентификации не меняется - сериализуем один раз
+    auth_frame = orjson.dumps({
+        "type": "auth",
+        "name": device_name,
+        "password": device_password
+    })
     while True:
         try:
             async with websockets.connect(SERVER_URI) as websocket:
-                print(f"[{DEVICE_NAME}] Пытаюсь подключиться к {SERVER_URI}...")
-                
+                print(f"[{device_name}] Пытаюсь подключиться к {SERVER_URI}...")
+
                 # 1. Аутентификация
-                auth_payload = {
-                    "type": "auth",
-                    "name": DEVICE_NAME,
-                    "password": DEVICE_PASSWORD
-                }
-                await websocket.send(json.dumps(auth_payload))
-                
+                await websocket.send(auth_frame)
+
                 response = await websocket.recv()
-                response_data = json.loads(response)
+                response_data = orjson.loads(response)
                 if response_data.get("status") != "ok":
-                    print(f"[{DEVICE_NAME}] Аутентификация не удалась: {response_data.get('message')}")
+                    print(f"[{device_name}] Аутентификация не удалась: {response_data.get('error')}")
                     return
 
-                print(f"[{DEVICE_NAME}] ✅ Аутентификация пройдена успешно!")
+                print(f"[{device_name}] ✅ Аутентификация пройдена успешно!")
 
                 # 2. Параллельно отправляем телеметрию и слушаем команды
-                consumer_task = asyncio.create_task(listen_for_commands(websocket))
-                producer_task = asyncio.create_task(send_telemetry(websocket))
-                
+                consumer_task = asyncio.create_task(listen_for_commands(websocket, device_name))
+                producer_task = asyncio.create_task(send_telemetry(websocket, device_name))
+
                 # Ждем завершения одной из задач (например, если соединение разорвется)
                 done, pending = await asyncio.wait(
                     [consumer_task, producer_task],
                     return_when=asyncio.FIRST_COMPLETED,
                 )
-                
+
                 for task in pending:
                     task.cancel()
 
         except (websockets.exceptions.ConnectionClosed, ConnectionRefusedError) as e:
-            print(f"[{DEVICE_NAME}] ❌ Соединение потеряно или не установлено: {e}. Повторная попытка через 5 секунд...")
+            print(f"[{device_name}] ❌ Соединение потеряно или не установлено: {e}. Повторная попытка через 5 секунд...")
             await asyncio.sleep(5)
         except Exception as e:
-            print(f"[{DEVICE_NAME}] Произошла непредвиденная ошибка: {e}")
+            print(f"[{device_name}] Произошла непредвиденная ошибка: {e}")
             await asyncio.sleep(5)
 
 
-async def listen_for_commands(websocket):
+async def listen_for_commands(websocket, device_name):
     """Слушает входящие команды от сервера."""
     async for message in websocket:
-        command = json.loads(message)
-        print(f"[{DEVICE_NAME}] 📩 Получена команда: {command}")
+        command = orjson.loads(message)
+        print(f"[{device_name}] 📩 Получена команда: {command}")
         # Здесь может быть логика обработки команды
 
-async def send_telemetry(websocket):
-    """Отправляет телеметрию каждые 10 секунд."""
+async def send_telemetry(websocket, device_name):
+    """Отправляет телеметрию каждые TELEMETRY_INTERVAL секунд."""
+    # Статические ключи создаются один раз, меняются только значения
+    telemetry_payload = {
+        "type": "telemetry",
+        "status": "idle",
+        "battery": 0.0,
+        "temperature": 0.0
+    }
     while True:
-        telemetry_payload = {
-            "type": "telemetry",
-            "status": "idle",
-            "battery": round(random.uniform(80.0, 100.0), 2),
-            "temperature": round(random.uniform(20.0, 35.0), 2)
-        }
-        await websocket.send(json.dumps(telemetry_payload))
-        print(f"[{DEVICE_NAME}] 📡 Телеметрия отправлена.")
-        await asyncio.sleep(10)
+        telemetry_payload["battery"] = round(random.uniform(80.0, 100.0), 2)
+        telemetry_payload["temperature"] = round(random.uniform(20.0, 35.0), 2)
+        await websocket.send(orjson.dumps(telemetry_payload))
+        print(f"[{device_name}] 📡 Телеметрия отправлена.")
+        await asyncio.sleep(TELEMETRY_INTERVAL)
+
+
+async def spawn(n):
+    """Запускает n виртуальных устройств в одном цикле событий."""
+    if not 1 <= n <= len(DEVICES):
+        raise ValueError(f"можно запустить от 1 до {len(DEVICES)} устройств (см. DEVICES), запрошено {n}")
+    await asyncio.gather(*[run_mock_device(name, password) for name, password in DEVICES[:n]])
 
 
 if __name__ == "__main__":
+    # python tests/mock_device.py [количество устройств]
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    if not 1 <= count <= len(DEVICES):
+        sys.exit(f"Ошибка: можно запустить от 1 до {len(DEVICES)} устройств (см. DEVICES), запрошено {count}")
     try:
-        asyncio.run(run_mock_device())
+        asyncio.run(spawn(count))
     except KeyboardInterrupt:
-        print(f"\n[{DEVICE_NAME}] Мок-устройство остановлено.")
+        print("\nМок-устройства остановлены.")